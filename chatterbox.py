@@ -1,28 +1,115 @@
 import os
+import hashlib
+import math
+import mimetypes
+import random
+import tempfile
+import threading
+import time
 import psycopg2
 import psycopg2.extras
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
 from flask import (
-    Flask, render_template_string, request, redirect, url_for, session,
-    flash, send_from_directory, abort
+    Flask, render_template_string, stream_template_string, request, redirect, url_for, session,
+    flash, get_flashed_messages, send_from_directory, abort, make_response, g, has_request_context,
+    Response
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import safe_join
 from urllib.parse import urlparse
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'supersecretkey123')
 
 AVATAR_FOLDER = 'avatars'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-
-ALLOWED_FULL_NAMES = {
-    "Lin Yirou",
-    "Sum Wy Lok",
-    "Sum Ee Lok",
-    "Sum Ann Lok",
-    "Lin Hongye"
+AVATAR_MAX_BYTES = int(os.environ.get('AVATAR_MAX_BYTES', 2 * 1024 * 1024))
+AVATAR_CHUNK_SIZE = 64 * 1024
+# Magic-byte prefixes of the image types we accept, mapped to the stored extension.
+AVATAR_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+# '' serves avatars from Python; 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd)
+# hand the file off to the fronting proxy instead of tying up a worker.
+AVATAR_SERVE_MODE = os.environ.get('AVATAR_SERVE_MODE', '').lower()
+AVATAR_ACCEL_PREFIX = os.environ.get('AVATAR_ACCEL_PREFIX', '/_avatars/')
+
+# Whole-request cap; leaves some room for the other profile fields.
+app.config['MAX_CONTENT_LENGTH'] = AVATAR_MAX_BYTES + 64 * 1024
+app.config['USE_X_SENDFILE'] = AVATAR_SERVE_MODE == 'x-sendfile'
+
+# Room membership lives in the database; positive lookups are cached per worker.
+MEMBERSHIP_CACHE_TTL = int(os.environ.get('MEMBERSHIP_CACHE_TTL', 60))
+MEMBERSHIP_CACHE_MAX = 10000
+_membership_cache = {}
+
+# Unread counts stop counting past this; the badge then shows "99+".
+UNREAD_CAP = 99
+# Only the user's most recent posts (by id) are checked for new replies, and at
+# most this many are listed, so the per-page cost stays fixed as history grows.
+UNREAD_POSTS_SCAN = 50
+UNREAD_POSTS_LIST = 10
+
+# Every connection gets bounded waits so a slow Postgres can't pin all workers.
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+DB_LOCK_TIMEOUT_MS = int(os.environ.get('DB_LOCK_TIMEOUT_MS', 2000))
+DB_BREAKER_THRESHOLD = int(os.environ.get('DB_BREAKER_THRESHOLD', 5))
+DB_BREAKER_COOLDOWN = int(os.environ.get('DB_BREAKER_COOLDOWN', 30))
+
+# Long pages (chat history, comment threads) are streamed: rows come from a
+# server-side cursor STREAM_ITERSIZE at a time and the HTML is flushed in
+# STREAM_BUFFER_BYTES pieces, so memory stays flat however long the history.
+STREAM_RENDER = os.environ.get('STREAM_RENDER', '1') == '1'
+STREAM_ITERSIZE = int(os.environ.get('STREAM_ITERSIZE', 200))
+STREAM_BUFFER_BYTES = int(os.environ.get('STREAM_BUFFER_BYTES', 8 * 1024))
+# idle_in_transaction_session_timeout for streamed queries.
+STREAM_IDLE_TIMEOUT_MS = int(os.environ.get('STREAM_IDLE_TIMEOUT_MS', 10000))
+
+# Last good front page, served to anonymous visitors while the database is down.
+_stale_cache = {}
+
+def parse_rate_limit(value):
+    # "count/seconds": a burst of `count` writes, refilled evenly over `seconds`.
+    count, seconds = value.split('/')
+    return int(count), float(seconds)
+
+# Token buckets per action, keyed by user and, when PROXY_FIX_HOPS is set, also by
+# client IP. Buckets are shared across workers through the rate_limits table; a
+# per-worker copy of each bucket rejects obvious floods without a database round trip.
+# PROXY_FIX_HOPS is the number of proxies in front of the app whose X-Forwarded-For
+# can be trusted. Left at 0, remote_addr is the router's address (e.g. on Heroku),
+# so there is no per-IP bucket rather than one bucket shared by every visitor.
+PROXY_FIX_HOPS = int(os.environ.get('PROXY_FIX_HOPS', 0))
+if PROXY_FIX_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_HOPS)
+RATE_LIMITS = {
+    'chat': parse_rate_limit(os.environ.get('RATE_LIMIT_CHAT', '20/60')),
+    'comment': parse_rate_limit(os.environ.get('RATE_LIMIT_COMMENT', '10/60')),
+    'post': parse_rate_limit(os.environ.get('RATE_LIMIT_POST', '5/300')),
 }
+LOCAL_BUCKETS_MAX = 10000
+_local_buckets = {}
+
+# Concurrent writes across all workers, enforced with WRITE_CONCURRENCY Postgres
+# advisory-lock slots. Excess writes wait up to WRITE_ADMISSION_WAIT
+# seconds for a slot and are then turned away with a 503.
+WRITE_CONCURRENCY = int(os.environ.get('WRITE_CONCURRENCY', 4))
+WRITE_ADMISSION_WAIT = float(os.environ.get('WRITE_ADMISSION_WAIT', 0.5))
+# First key of the two-key advisory locks used as write slots ('CBOX').
+WRITE_SLOT_LOCK_SPACE = 0x43424F58
+
+# Counters are kept per worker: each /metrics scrape reports the worker that
+# served it (its pid is the first line), so sum across pids when aggregating.
+# The endpoint is disabled unless METRICS_TOKEN is set.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+_counters = Counter()
+_counters_lock = threading.Lock()
 
 os.makedirs(AVATAR_FOLDER, exist_ok=True)
 
@@ -30,7 +117,54 @@ os.makedirs(AVATAR_FOLDER, exist_ok=True)
 # DB connection helpers
 # ----------------------
 
-def get_db_connection():
+class DatabaseUnavailable(Exception):
+    pass
+
+# Opens after `threshold` consecutive failures; after `cooldown` one request probes.
+class CircuitBreaker:
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    # 'closed', 'probe' (this caller gets the half-open probe) or None to fail fast.
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.opened_at = time.monotonic()
+                return 'probe'
+            return None
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+db_breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_COOLDOWN)
+
+def get_db_connection(statement_timeout_ms=DB_STATEMENT_TIMEOUT_MS):
+    # The probe request keeps its pass for every connection it opens until one
+    # of them fails; success is recorded once, in record_db_outcome.
+    if not (has_request_context() and g.get('db_probe') and not g.get('db_failed')):
+        state = db_breaker.allow()
+        if state is None:
+            raise DatabaseUnavailable('circuit breaker open')
+        if state == 'probe' and has_request_context():
+            g.db_probe = True
     DATABASE_URL = os.environ.get('DATABASE_URL')
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL env var not set")
@@ -40,21 +174,85 @@ def get_db_connection():
     database = result.path[1:]
     hostname = result.hostname
     port = result.port or 5432
-    conn = psycopg2.connect(
-        dbname=database,
-        user=username,
-        password=password,
-        host=hostname,
-        port=port
-    )
+    try:
+        conn = psycopg2.connect(
+            dbname=database,
+            user=username,
+            password=password,
+            host=hostname,
+            port=port,
+            connect_timeout=DB_CONNECT_TIMEOUT,
+            options=f'-c statement_timeout={statement_timeout_ms} -c lock_timeout={DB_LOCK_TIMEOUT_MS}'
+        )
+    except psycopg2.OperationalError as e:
+        record_db_failure()
+        raise DatabaseUnavailable(str(e)) from e
+    if has_request_context():
+        g.db_used = True
     return conn
 
+def record_db_failure():
+    db_breaker.record_failure()
+    if has_request_context():
+        g.db_failed = True
+
 def dict_cursor(conn):
     return conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-def init_db():
+def query_rows(query, params):
+    # Lazy server-side cursor rows when streaming, else a fetchall() list.
     conn = get_db_connection()
+    if not STREAM_RENDER:
+        c = dict_cursor(conn)
+        c.execute(query, params)
+        rows = c.fetchall()
+        c.close()
+        conn.close()
+        return rows
+    c = conn.cursor(name='query_rows', cursor_factory=psycopg2.extras.DictCursor)
+    c.itersize = STREAM_ITERSIZE
+    try:
+        conn.cursor().execute('SET LOCAL idle_in_transaction_session_timeout = %s', (STREAM_IDLE_TIMEOUT_MS,))
+        c.execute(query, params)
+    except BaseException:
+        conn.close()
+        raise
+    def rows():
+        fetched_at = time.monotonic()
+        try:
+            while True:
+                try:
+                    batch = c.fetchmany(c.itersize)
+                except psycopg2.Error:
+                    # Past the error handlers here; a client stall is not the database's fault.
+                    if (time.monotonic() - fetched_at) * 1000 < STREAM_IDLE_TIMEOUT_MS:
+                        record_db_failure()
+                    raise
+                if not batch:
+                    break
+                yield from batch
+                fetched_at = time.monotonic()
+        finally:
+            conn.close()
+    return rows()
+
+def column_exists(c, table, column):
+    c.execute('''
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    ''', (table, column))
+    return c.fetchone() is not None
+
+# Advisory lock key held by init_db so workers booting together migrate one at a time.
+INIT_DB_LOCK_KEY = 0x43424F5800
+
+def init_db():
+    # Migrations and index builds may legitimately run long.
+    conn = get_db_connection(statement_timeout_ms=0)
     c = conn.cursor()
+    # Held until the commit below; later workers wait here, then see the finished schema.
+    c.execute('SET LOCAL lock_timeout = 0')
+    c.execute('SELECT pg_advisory_xact_lock(%s)', (INIT_DB_LOCK_KEY,))
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
@@ -83,24 +281,241 @@ def init_db():
             timestamp TIMESTAMP NOT NULL
         );
     ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            owner_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+            created_at TIMESTAMP NOT NULL
+        );
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS room_members (
+            room_id INTEGER NOT NULL REFERENCES rooms(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (room_id, user_id)
+        );
+    ''')
+    if not column_exists(c, 'room_members', 'last_read_id'):
+        c.execute('ALTER TABLE room_members ADD COLUMN last_read_id INTEGER NOT NULL DEFAULT 0;')
+    c.execute('CREATE INDEX IF NOT EXISTS room_members_user_idx ON room_members (user_id, room_id);')
     c.execute('''
         CREATE TABLE IF NOT EXISTS chat_messages (
             id SERIAL PRIMARY KEY,
+            room_id INTEGER NOT NULL REFERENCES rooms(id) ON DELETE CASCADE,
             user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
             message TEXT NOT NULL,
             timestamp TIMESTAMP NOT NULL
         );
     ''')
+    # Databases from before rooms existed: move the single global chat into a
+    # "General" room whose members are everyone who has posted there. Guarded so
+    # the scan and the exclusive locks only happen once, not on every boot.
+    if not column_exists(c, 'chat_messages', 'room_id'):
+        c.execute('ALTER TABLE chat_messages ADD COLUMN room_id INTEGER REFERENCES rooms(id) ON DELETE CASCADE;')
+        c.execute('''
+            INSERT INTO rooms (name, created_at)
+            SELECT 'General', %s WHERE EXISTS (SELECT 1 FROM chat_messages)
+            ON CONFLICT (name) DO NOTHING;
+        ''', (datetime.utcnow(),))
+        c.execute("UPDATE chat_messages SET room_id = (SELECT id FROM rooms WHERE name = 'General');")
+        c.execute('''
+            INSERT INTO room_members (room_id, user_id, last_read_id)
+            SELECT room_id, user_id, (SELECT MAX(id) FROM chat_messages WHERE room_id = m.room_id)
+            FROM (SELECT DISTINCT room_id, user_id FROM chat_messages) m
+            ON CONFLICT DO NOTHING;
+        ''')
+        c.execute('ALTER TABLE chat_messages ALTER COLUMN room_id SET NOT NULL;')
+    # Each room's history is its own index range.
+    c.execute('CREATE INDEX IF NOT EXISTS chat_messages_room_ts_idx ON chat_messages (room_id, timestamp, id);')
+    # Unread counts are "id > marker" range counts over these.
+    c.execute('CREATE INDEX IF NOT EXISTS chat_messages_room_id_idx ON chat_messages (room_id, id);')
+    c.execute('CREATE INDEX IF NOT EXISTS comments_post_id_idx ON comments (post_id, id);')
+    # One row per (user, post) the user has taken part in: authored or commented.
+    c.execute("SELECT to_regclass('post_reads') IS NULL")
+    backfill_post_reads = c.fetchone()[0]
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS post_reads (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            post_id INTEGER NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+            last_comment_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, post_id)
+        );
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL
+        );
+    ''')
+    if column_exists(c, 'rate_limits', 'allowed'):
+        c.execute('ALTER TABLE rate_limits DROP COLUMN allowed;')
+    # A bucket idle this long is full again, so dropping it changes nothing.
+    c.execute("DELETE FROM rate_limits WHERE updated_at < now() - interval '1 day';")
+    if backfill_post_reads:
+        c.execute('''
+            INSERT INTO post_reads (user_id, post_id, last_comment_id)
+            SELECT p.user_id, p.post_id, COALESCE(MAX(comments.id), 0)
+            FROM (
+                SELECT user_id, id AS post_id FROM posts
+                UNION
+                SELECT user_id, post_id FROM comments
+            ) p
+            LEFT JOIN comments ON comments.post_id = p.post_id
+            GROUP BY p.user_id, p.post_id;
+        ''')
     conn.commit()
     c.close()
     conn.close()
 
+# ----------------------
+# Write flood control
+# ----------------------
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class WriteOverloaded(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    # Refill, then return seconds until a token is available (0 if one is).
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+def count_event(name, delta=1):
+    with _counters_lock:
+        _counters[name] += delta
+
+# Token count of a rate_limits row after refilling it up to now().
+_RATE_LIMIT_REFILL = "LEAST(%(burst)s, tokens + EXTRACT(EPOCH FROM now() - updated_at)::float8 * %(rate)s)"
+
+def check_rate_limit(action, user_id, conn):
+    # Takes a token from every bucket for `action` or none; raises RateLimited.
+    capacity, period = RATE_LIMITS[action]
+    keys = [f'{action}:user:{user_id}']
+    if PROXY_FIX_HOPS:
+        keys.append(f'{action}:ip:{request.remote_addr}')
+    keys.sort()
+    if len(_local_buckets) >= LOCAL_BUCKETS_MAX:
+        _local_buckets.clear()
+    local = [_local_buckets.setdefault(key, TokenBucket(capacity, period)) for key in keys]
+    wait = max(bucket.wait_time() for bucket in local)
+    if wait:
+        count_event(f'rate_limited_local:{action}')
+        raise RateLimited(wait)
+    c = conn.cursor()
+    params = {'keys': keys, 'burst': capacity, 'rate': capacity / period}
+    c.execute('''
+        INSERT INTO rate_limits (key, tokens, updated_at)
+        SELECT key, %(burst)s, now() FROM unnest(%(keys)s) AS key ORDER BY key
+        ON CONFLICT (key) DO NOTHING
+    ''', params)
+    c.execute(f'''
+        SELECT {_RATE_LIMIT_REFILL} FROM rate_limits
+        WHERE key = ANY(%(keys)s) ORDER BY key FOR UPDATE
+    ''', params)
+    tokens = min(row[0] for row in c.fetchall())
+    if tokens >= 1:
+        c.execute(f'''
+            UPDATE rate_limits SET tokens = {_RATE_LIMIT_REFILL} - 1, updated_at = now()
+            WHERE key = ANY(%(keys)s)
+        ''', params)
+    conn.commit()
+    c.close()
+    if tokens < 1:
+        count_event(f'rate_limited_shared:{action}')
+        raise RateLimited((1 - tokens) * period / capacity)
+    for bucket in local:
+        bucket.take()
+    count_event(f'rate_allowed:{action}')
+
+@contextmanager
+def write_admission():
+    # Yields a connection holding a write slot; closing it frees the slot.
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        # One blocking wait on a random slot; lock_timeout ends it after WRITE_ADMISSION_WAIT.
+        c.execute('SET LOCAL lock_timeout = %s', (int(WRITE_ADMISSION_WAIT * 1000),))
+        try:
+            c.execute('SELECT pg_advisory_lock(%s, %s)',
+                      (WRITE_SLOT_LOCK_SPACE, random.randrange(WRITE_CONCURRENCY)))
+        except psycopg2.OperationalError as e:
+            if e.pgcode != '55P03':  # lock_not_available
+                raise
+            count_event('write_rejected')
+            raise WriteOverloaded()
+        # Ends the SET LOCAL; the session-level advisory lock stays held.
+        conn.commit()
+        c.close()
+        count_event('write_admitted')
+        yield conn
+    finally:
+        conn.close()
+
 # ----------------------
 # Helper functions
 # ----------------------
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def sniff_image_type(head):
+    for signature, ext in AVATAR_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+def save_avatar(avatar_file):
+    # Returns the path under AVATAR_FOLDER, or None for a non-image or oversized upload.
+    stream = avatar_file.stream
+    head = stream.read(16)
+    ext = sniff_image_type(head)
+    if not ext:
+        return None
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=AVATAR_FOLDER, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            chunk = head
+            while chunk:
+                size += len(chunk)
+                if size > AVATAR_MAX_BYTES:
+                    raise ValueError('avatar too large')
+                digest.update(chunk)
+                out.write(chunk)
+                chunk = stream.read(AVATAR_CHUNK_SIZE)
+            out.flush()
+            os.fsync(out.fileno())
+        name = digest.hexdigest()
+        relpath = f"{name[:2]}/{name[2:4]}/{name}.{ext}"
+        final_path = os.path.join(AVATAR_FOLDER, relpath)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        # mkstemp creates 0600; a fronting proxy needs to be able to read it.
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, final_path)
+    except ValueError:
+        os.unlink(tmp_path)
+        return None
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return relpath
 
 def get_user_by_username(username):
     conn = get_db_connection()
@@ -133,27 +548,40 @@ def get_post(post_id):
     conn.close()
     return post
 
-def get_comments(post_id):
+def get_latest_comment_id(post_id):
     conn = get_db_connection()
-    c = dict_cursor(conn)
-    c.execute('''
-        SELECT comments.*, users.nickname, users.username, users.avatar FROM comments
-        JOIN users ON comments.user_id = users.id
-        WHERE post_id = %s ORDER BY timestamp ASC
-    ''', (post_id,))
-    comments = c.fetchall()
+    c = conn.cursor()
+    c.execute('SELECT COALESCE(MAX(id), 0) FROM comments WHERE post_id = %s', (post_id,))
+    latest_id = c.fetchone()[0]
     c.close()
     conn.close()
-    return comments
+    return latest_id
 
-def get_recent_chat(limit=6):
+def get_comments(post_id, upto_id):
+    # Bounded by id so the page shows exactly what mark_post_read marks as read.
+    return query_rows('''
+        SELECT comments.*, users.nickname, users.username, users.avatar FROM comments
+        JOIN users ON comments.user_id = users.id
+        WHERE post_id = %s AND comments.id <= %s ORDER BY timestamp ASC
+    ''', (post_id, upto_id))
+
+def get_recent_chat(user_id, limit=6):
+    # One index range scan per room the user belongs to, then merge.
     conn = get_db_connection()
     c = dict_cursor(conn)
     c.execute('''
-        SELECT chat_messages.*, users.nickname, users.username, users.avatar FROM chat_messages
-        JOIN users ON chat_messages.user_id = users.id
-        ORDER BY timestamp DESC LIMIT %s
-    ''', (limit,))
+        SELECT m.*, rooms.name AS room_name, users.nickname, users.username, users.avatar
+        FROM room_members
+        JOIN rooms ON rooms.id = room_members.room_id
+        CROSS JOIN LATERAL (
+            SELECT * FROM chat_messages
+            WHERE chat_messages.room_id = room_members.room_id
+            ORDER BY timestamp DESC, id DESC LIMIT %s
+        ) m
+        JOIN users ON m.user_id = users.id
+        WHERE room_members.user_id = %s
+        ORDER BY m.timestamp DESC, m.id DESC LIMIT %s
+    ''', (limit, user_id, limit))
     messages = c.fetchall()
     c.close()
     conn.close()
@@ -172,6 +600,197 @@ def get_posts(limit=10):
     conn.close()
     return posts
 
+def get_room(room_id):
+    conn = get_db_connection()
+    c = dict_cursor(conn)
+    c.execute('SELECT * FROM rooms WHERE id = %s', (room_id,))
+    room = c.fetchone()
+    c.close()
+    conn.close()
+    return room
+
+def get_user_rooms(user_id):
+    conn = get_db_connection()
+    c = dict_cursor(conn)
+    c.execute('''
+        SELECT rooms.*, unread.n AS unread FROM room_members
+        JOIN rooms ON rooms.id = room_members.room_id
+        CROSS JOIN LATERAL (
+            SELECT count(*) AS n FROM (
+                SELECT 1 FROM chat_messages
+                WHERE chat_messages.room_id = room_members.room_id
+                  AND chat_messages.id > room_members.last_read_id
+                LIMIT %s
+            ) capped
+        ) unread
+        WHERE room_members.user_id = %s ORDER BY rooms.name ASC
+    ''', (UNREAD_CAP + 1, user_id))
+    rooms = c.fetchall()
+    c.close()
+    conn.close()
+    return rooms
+
+def get_room_members(room_id):
+    conn = get_db_connection()
+    c = dict_cursor(conn)
+    c.execute('''
+        SELECT users.id, users.nickname, users.username, users.avatar FROM room_members
+        JOIN users ON room_members.user_id = users.id
+        WHERE room_members.room_id = %s ORDER BY users.username ASC
+    ''', (room_id,))
+    members = c.fetchall()
+    c.close()
+    conn.close()
+    return members
+
+def get_latest_message_id(room_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('SELECT COALESCE(MAX(id), 0) FROM chat_messages WHERE room_id = %s', (room_id,))
+    latest_id = c.fetchone()[0]
+    c.close()
+    conn.close()
+    return latest_id
+
+def get_room_messages(room_id, upto_id):
+    # Bounded by id so the page shows exactly what mark_room_read marks as read.
+    return query_rows('''
+        SELECT chat_messages.*, users.nickname, users.username, users.avatar FROM chat_messages
+        JOIN users ON chat_messages.user_id = users.id
+        WHERE room_id = %s AND chat_messages.id <= %s ORDER BY timestamp ASC, chat_messages.id ASC
+    ''', (room_id, upto_id))
+
+def is_room_member(room_id, user_id):
+    key = (room_id, user_id)
+    expiry = _membership_cache.get(key)
+    if expiry and expiry > time.monotonic():
+        return True
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s', (room_id, user_id))
+    member = c.fetchone() is not None
+    c.close()
+    conn.close()
+    # Only grants are cached, so a newly added member is never locked out by a
+    # stale entry in another worker.
+    if member:
+        if len(_membership_cache) >= MEMBERSHIP_CACHE_MAX:
+            _membership_cache.clear()
+        _membership_cache[key] = time.monotonic() + MEMBERSHIP_CACHE_TTL
+    return member
+
+def add_room_member(room_id, user_id):
+    # New members start caught up rather than with the whole history unread.
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO room_members (room_id, user_id, last_read_id)
+        SELECT %s, %s, COALESCE(MAX(id), 0) FROM chat_messages WHERE room_id = %s
+        ON CONFLICT DO NOTHING
+    ''', (room_id, user_id, room_id))
+    conn.commit()
+    c.close()
+    conn.close()
+
+def mark_room_read(room_id, user_id, upto_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        UPDATE room_members SET last_read_id = GREATEST(last_read_id, %s)
+        WHERE room_id = %s AND user_id = %s
+    ''', (upto_id, room_id, user_id))
+    conn.commit()
+    c.close()
+    conn.close()
+    invalidate_unread_counts()
+
+def mark_post_read(post_id, user_id, upto_id):
+    # Only touches posts the user already takes part in; viewing alone does not subscribe.
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        UPDATE post_reads SET last_comment_id = GREATEST(last_comment_id, %s)
+        WHERE post_id = %s AND user_id = %s
+    ''', (upto_id, post_id, user_id))
+    conn.commit()
+    c.close()
+    conn.close()
+    invalidate_unread_counts()
+
+def get_unread_counts(user_id):
+    # Capped index range counts past each marker; cached in g for the request.
+    if 'unread_counts' in g:
+        return g.unread_counts
+    conn = get_db_connection()
+    c = dict_cursor(conn)
+    c.execute('''
+        SELECT COALESCE(SUM(unread.n), 0) FROM room_members
+        CROSS JOIN LATERAL (
+            SELECT count(*) AS n FROM (
+                SELECT 1 FROM chat_messages
+                WHERE chat_messages.room_id = room_members.room_id
+                  AND chat_messages.id > room_members.last_read_id
+                LIMIT %s
+            ) capped
+        ) unread
+        WHERE room_members.user_id = %s
+    ''', (UNREAD_CAP + 1, user_id))
+    chat = c.fetchone()[0]
+    c.execute('''
+        SELECT posts.id, posts.subject, unread.n AS unread FROM (
+            SELECT * FROM post_reads WHERE user_id = %s
+            ORDER BY post_id DESC LIMIT %s
+        ) recent
+        JOIN posts ON posts.id = recent.post_id
+        CROSS JOIN LATERAL (
+            SELECT count(*) AS n FROM (
+                SELECT 1 FROM comments
+                WHERE comments.post_id = recent.post_id
+                  AND comments.id > recent.last_comment_id
+                LIMIT %s
+            ) capped
+        ) unread
+        WHERE unread.n > 0
+        ORDER BY posts.id DESC
+    ''', (user_id, UNREAD_POSTS_SCAN, UNREAD_CAP + 1))
+    posts = c.fetchall()
+    c.close()
+    conn.close()
+    comments = 0
+    for post in posts:
+        comments += post['unread']
+        if comments > UNREAD_CAP:
+            break
+    g.unread_counts = {
+        'chat': chat,
+        'comments': comments,
+        'posts': posts[:UNREAD_POSTS_LIST],
+    }
+    return g.unread_counts
+
+def invalidate_unread_counts():
+    g.pop('unread_counts', None)
+
+def render_page(template, **context):
+    if not STREAM_RENDER:
+        return render_template_string(template, **context)
+    # The session cookie goes out with the headers, before the body streams,
+    # so pop the flashes now rather than from inside the template.
+    get_flashed_messages()
+    return Response(buffered_chunks(stream_template_string(template, **context)))
+
+def buffered_chunks(chunks):
+    # Jinja yields many tiny pieces; coalesce them so each write is worthwhile.
+    buf, size = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_BUFFER_BYTES:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
 def current_user():
     if 'user_id' in session:
         return get_user_by_id(session['user_id'])
@@ -184,8 +803,18 @@ def current_user():
 @app.route('/')
 def home():
     user = current_user()
-    posts = get_posts()
-    recent_chat = get_recent_chat() if user else None
+    try:
+        posts = get_posts()
+    except (DatabaseUnavailable, psycopg2.OperationalError) as e:
+        # Also covers a slow database hitting statement_timeout (QueryCanceledError).
+        if user or 'home_posts' not in _stale_cache:
+            raise
+        if not isinstance(e, DatabaseUnavailable):
+            record_db_failure()
+        return render_template_string(TEMPLATE, page='home', user=None, posts=_stale_cache['home_posts'],
+                                      recent_chat=None, stale=True)
+    _stale_cache['home_posts'] = posts
+    recent_chat = get_recent_chat(user['id']) if user else None
     return render_template_string(TEMPLATE, page='home', user=user, posts=posts, recent_chat=recent_chat)
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -247,11 +876,12 @@ def profile():
         bio = request.form.get('bio', '').strip()
         avatar_file = request.files.get('avatar')
         avatar_filename = user['avatar']
-        if avatar_file and allowed_file(avatar_file.filename):
-            filename = secure_filename(avatar_file.filename)
-            filename = f"{user['id']}_{filename}"
-            avatar_file.save(os.path.join(AVATAR_FOLDER, filename))
-            avatar_filename = filename
+        if avatar_file and avatar_file.filename:
+            avatar_filename = save_avatar(avatar_file)
+            if not avatar_filename:
+                flash(f'Avatar must be a PNG, JPEG or GIF image of at most '
+                      f'{AVATAR_MAX_BYTES // 1024} KB.', 'warning')
+                return redirect(url_for('profile'))
         conn = get_db_connection()
         c = conn.cursor()
         c.execute('UPDATE users SET nickname=%s, bio=%s, avatar=%s WHERE id=%s',
@@ -263,10 +893,27 @@ def profile():
         return redirect(url_for('profile'))
     return render_template_string(TEMPLATE, page='profile', user=user)
 
-@app.route('/avatars/<filename>')
+@app.route('/avatars/<path:filename>')
 def avatars(filename):
+    if AVATAR_SERVE_MODE == 'x-accel':
+        path = safe_join(AVATAR_FOLDER, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = AVATAR_ACCEL_PREFIX + filename
+        response.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return response
+    # With AVATAR_SERVE_MODE=x-sendfile, USE_X_SENDFILE makes this emit the header.
     return send_from_directory(AVATAR_FOLDER, filename)
 
+@app.errorhandler(413)
+def request_too_large(e):
+    # MAX_CONTENT_LENGTH is sized for avatars but applies to every route.
+    if request.endpoint != 'profile':
+        return e
+    flash(f'Upload too large. Avatars may be at most {AVATAR_MAX_BYTES // 1024} KB.', 'warning')
+    return redirect(url_for('profile'))
+
 @app.route('/create_post', methods=['GET', 'POST'])
 def create_post():
     user = current_user()
@@ -279,13 +926,15 @@ def create_post():
         if not subject or not body:
             flash('Subject and body are required.', 'warning')
             return redirect(url_for('create_post'))
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('INSERT INTO posts (user_id, subject, body, timestamp) VALUES (%s, %s, %s, %s)',
-                  (user['id'], subject, body, datetime.utcnow()))
-        conn.commit()
-        c.close()
-        conn.close()
+        with write_admission() as conn:
+            check_rate_limit('post', user['id'], conn)
+            c = conn.cursor()
+            c.execute('INSERT INTO posts (user_id, subject, body, timestamp) VALUES (%s, %s, %s, %s) RETURNING id',
+                      (user['id'], subject, body, datetime.utcnow()))
+            post_id = c.fetchone()[0]
+            c.execute('INSERT INTO post_reads (user_id, post_id) VALUES (%s, %s)', (user['id'], post_id))
+            conn.commit()
+            c.close()
         flash('Post created.', 'success')
         return redirect(url_for('home'))
     return render_template_string(TEMPLATE, page='create_post', user=user)
@@ -304,68 +953,209 @@ def view_post(post_id):
         if not body:
             flash('Comment cannot be empty.', 'warning')
             return redirect(url_for('view_post', post_id=post_id))
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('INSERT INTO comments (post_id, user_id, body, timestamp) VALUES (%s, %s, %s, %s)',
-                  (post_id, user['id'], body, datetime.utcnow()))
-        conn.commit()
-        c.close()
-        conn.close()
+        with write_admission() as conn:
+            check_rate_limit('comment', user['id'], conn)
+            c = conn.cursor()
+            c.execute('INSERT INTO comments (post_id, user_id, body, timestamp) VALUES (%s, %s, %s, %s) RETURNING id',
+                      (post_id, user['id'], body, datetime.utcnow()))
+            comment_id = c.fetchone()[0]
+            c.execute('''
+                INSERT INTO post_reads (user_id, post_id, last_comment_id) VALUES (%s, %s, %s)
+                ON CONFLICT (user_id, post_id) DO UPDATE
+                SET last_comment_id = GREATEST(post_reads.last_comment_id, EXCLUDED.last_comment_id)
+            ''', (user['id'], post_id, comment_id))
+            conn.commit()
+            c.close()
+        invalidate_unread_counts()
         flash('Comment added.', 'success')
         return redirect(url_for('view_post', post_id=post_id))
-    comments = get_comments(post_id)
-    return render_template_string(TEMPLATE, page='view_post', user=user, post=post, comments=comments)
+    latest_id = get_latest_comment_id(post_id)
+    comments = get_comments(post_id, latest_id)
+    if user:
+        mark_post_read(post_id, user['id'], latest_id)
+    return render_page(TEMPLATE, page='view_post', user=user, post=post, comments=comments)
 
-@app.route('/chat_auth', methods=['GET', 'POST'])
-def chat_auth():
+@app.route('/chat', methods=['GET', 'POST'])
+def chat():
     user = current_user()
     if not user:
         flash('Login required.', 'warning')
         return redirect(url_for('login'))
     if request.method == 'POST':
-        full_name = request.form.get('full_name', '').strip()
-        if full_name in ALLOWED_FULL_NAMES:
-            session['chat_access'] = True
-            flash('Access granted to chat room.', 'success')
+        name = request.form.get('name', '').strip()
+        if not name:
+            flash('Room name is required.', 'warning')
+            return redirect(url_for('chat'))
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO rooms (name, owner_id, created_at) VALUES (%s, %s, %s)
+            ON CONFLICT (name) DO NOTHING RETURNING id
+        ''', (name, user['id'], datetime.utcnow()))
+        row = c.fetchone()
+        if row:
+            c.execute('INSERT INTO room_members (room_id, user_id) VALUES (%s, %s)', (row[0], user['id']))
+        conn.commit()
+        c.close()
+        conn.close()
+        if not row:
+            flash('A room with that name already exists.', 'warning')
             return redirect(url_for('chat'))
-        else:
-            flash('Access denied. Your full name is not authorized.', 'danger')
-    return render_template_string(TEMPLATE, page='chat_auth', user=user)
+        flash('Room created.', 'success')
+        return redirect(url_for('chat_room', room_id=row[0]))
+    rooms = get_user_rooms(user['id'])
+    return render_template_string(TEMPLATE, page='chat_rooms', user=user, rooms=rooms)
 
-@app.route('/chat', methods=['GET', 'POST'])
-def chat():
+@app.route('/chat/<int:room_id>', methods=['GET', 'POST'])
+def chat_room(room_id):
     user = current_user()
     if not user:
         flash('Login required.', 'warning')
         return redirect(url_for('login'))
-    if not session.get('chat_access'):
-        return redirect(url_for('chat_auth'))
+    room = get_room(room_id)
+    if not room:
+        abort(404)
+    if not is_room_member(room_id, user['id']):
+        flash('You are not a member of that room.', 'danger')
+        return redirect(url_for('chat'))
     if request.method == 'POST':
         message = request.form.get('message', '').strip()
         if message:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute('INSERT INTO chat_messages (user_id, message, timestamp) VALUES (%s, %s, %s)',
-                      (user['id'], message, datetime.utcnow()))
-            conn.commit()
-            c.close()
-            conn.close()
-    conn = get_db_connection()
-    c = dict_cursor(conn)
-    c.execute('''
-        SELECT chat_messages.*, users.nickname, users.username, users.avatar FROM chat_messages
-        JOIN users ON chat_messages.user_id = users.id
-        ORDER BY timestamp ASC
-    ''')
-    messages = c.fetchall()
-    c.close()
-    conn.close()
-    return render_template_string(TEMPLATE, page='chat', user=user, messages=messages)
+            with write_admission() as conn:
+                check_rate_limit('chat', user['id'], conn)
+                c = conn.cursor()
+                c.execute('INSERT INTO chat_messages (room_id, user_id, message, timestamp) VALUES (%s, %s, %s, %s)',
+                          (room_id, user['id'], message, datetime.utcnow()))
+                conn.commit()
+                c.close()
+            invalidate_unread_counts()
+    latest_id = get_latest_message_id(room_id)
+    messages = get_room_messages(room_id, latest_id)
+    mark_room_read(room_id, user['id'], latest_id)
+    members = get_room_members(room_id)
+    return render_page(TEMPLATE, page='chat', user=user, room=room, members=members, messages=messages)
+
+@app.route('/chat/<int:room_id>/members', methods=['POST'])
+def chat_room_members(room_id):
+    user = current_user()
+    if not user:
+        flash('Login required.', 'warning')
+        return redirect(url_for('login'))
+    if not get_room(room_id):
+        abort(404)
+    if not is_room_member(room_id, user['id']):
+        flash('You are not a member of that room.', 'danger')
+        return redirect(url_for('chat'))
+    username = request.form.get('username', '').strip()
+    member = get_user_by_username(username) if username else None
+    if not member:
+        flash('No user with that username.', 'warning')
+    else:
+        add_room_member(room_id, member['id'])
+        flash(f"{member['nickname'] or member['username']} added to the room.", 'success')
+    return redirect(url_for('chat_room', room_id=room_id))
+
+@app.errorhandler(DatabaseUnavailable)
+@app.errorhandler(psycopg2.OperationalError)
+def database_unavailable(e):
+    # Connect failures were already counted in get_db_connection; count the
+    # rest here (statement/lock timeouts, dropped connections).
+    if not isinstance(e, DatabaseUnavailable):
+        record_db_failure()
+    response = make_response(UNAVAILABLE_TEMPLATE, 503)
+    response.headers['Retry-After'] = str(DB_BREAKER_COOLDOWN)
+    return response
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    response = make_response(SLOW_DOWN_TEMPLATE, 429)
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+@app.errorhandler(WriteOverloaded)
+def write_overloaded(e):
+    response = make_response(BUSY_TEMPLATE, 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.route('/metrics')
+def metrics():
+    if not METRICS_TOKEN or request.headers.get('X-Metrics-Token') != METRICS_TOKEN:
+        abort(404)
+    with _counters_lock:
+        counters = sorted(_counters.items())
+    lines = [f'pid {os.getpid()}']
+    lines += [f'{name} {value}' for name, value in counters]
+    lines.append(f'db_breaker_open {int(db_breaker.is_open())}')
+    lines.append(f'db_breaker_failures {db_breaker.failures}')
+    # Write slots are advisory locks, so this one is global, not per worker.
+    try:
+        conn = get_db_connection()
+    except DatabaseUnavailable:
+        conn = None
+    if conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT count(*) FROM pg_locks
+            WHERE locktype = 'advisory' AND granted AND classid = %s AND objsubid = 2
+              AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+        ''', (WRITE_SLOT_LOCK_SPACE,))
+        lines.append(f'write_slots_in_use {c.fetchone()[0]}')
+        c.close()
+        conn.close()
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+@app.teardown_request
+def record_db_outcome(exc):
+    if g.get('db_used') and not g.get('db_failed') and exc is None:
+        db_breaker.record_success()
+
+@app.context_processor
+def inject_unread_counts():
+    user_id = session.get('user_id')
+    if not user_id or (db_breaker.is_open() and not g.get('db_probe')):
+        return dict(unread=None)
+    return dict(unread=get_unread_counts(user_id))
+
+@app.template_filter('unread_label')
+def unread_label(count):
+    return f'{UNREAD_CAP}+' if count > UNREAD_CAP else str(count)
 
 # ----------------------
 # Template HTML string
 # ----------------------
 
+# Kept free of the database and external assets so it is cheap to serve during an outage.
+UNAVAILABLE_TEMPLATE = """<!doctype html>
+<html lang="en">
+<head><meta charset="utf-8"><title>Chatterbox is taking a nap</title></head>
+<body style="font-family: sans-serif; background: #ffd700; color: #b22222; text-align: center; padding-top: 4rem;">
+  <h1>Chatterbox is taking a nap</h1>
+  <p>We can't reach the database right now. Please try again in a little while.</p>
+</body>
+</html>
+"""
+
+SLOW_DOWN_TEMPLATE = """<!doctype html>
+<html lang="en">
+<head><meta charset="utf-8"><title>Slow down</title></head>
+<body style="font-family: sans-serif; background: #ffd700; color: #b22222; text-align: center; padding-top: 4rem;">
+  <h1>Slow down, chicken!</h1>
+  <p>You're posting faster than we allow. Wait a moment, then go back and try again.</p>
+</body>
+</html>
+"""
+
+BUSY_TEMPLATE = """<!doctype html>
+<html lang="en">
+<head><meta charset="utf-8"><title>Chatterbox is busy</title></head>
+<body style="font-family: sans-serif; background: #ffd700; color: #b22222; text-align: center; padding-top: 4rem;">
+  <h1>Chatterbox is busy</h1>
+  <p>Too many people are posting at once. Go back and try again in a second.</p>
+</body>
+</html>
+"""
+
 TEMPLATE = """<!doctype html>
 <html lang="en">
 <head>
@@ -506,7 +1296,14 @@ TEMPLATE = """<!doctype html>
       {% if user %}
         <a class="btn btn-sm btn-outline-light me-2" href="{{ url_for('profile') }}">Profile</a>
         <a class="btn btn-sm btn-outline-light me-2" href="{{ url_for('create_post') }}">New Post</a>
-        <a class="btn btn-sm btn-outline-light me-2" href="{{ url_for('chat_auth') }}">Chat Room</a>
+        {% if unread and unread.comments %}
+          <a class="btn btn-sm btn-outline-light me-2" href="{{ url_for('home') }}#new-replies">
+            Replies <span class="badge bg-warning text-dark">{{ unread.comments|unread_label }}</span>
+          </a>
+        {% endif %}
+        <a class="btn btn-sm btn-outline-light me-2" href="{{ url_for('chat') }}">
+          Chat Rooms{% if unread and unread.chat %} <span class="badge bg-warning text-dark">{{ unread.chat|unread_label }}</span>{% endif %}
+        </a>
         <a class="btn btn-sm btn-outline-light" href="{{ url_for('logout') }}">Logout</a>
       {% else %}
         <a class="btn btn-sm btn-outline-light me-2" href="{{ url_for('login') }}">Login</a>
@@ -529,6 +1326,20 @@ TEMPLATE = """<!doctype html>
 
     {# HOME PAGE #}
     {% if page == 'home' %}
+      {% if stale %}
+        <div class="alert alert-warning">Chatterbox is having trouble right now; you are seeing a saved copy of this page.</div>
+      {% endif %}
+      {% if unread and unread.posts %}
+        <h2 id="new-replies">New Replies</h2>
+        <ul class="list-group mb-3">
+          {% for post in unread.posts %}
+          <li class="list-group-item">
+            <a href="{{ url_for('view_post', post_id=post.id) }}"><strong>{{ post.subject }}</strong></a>
+            <span class="badge bg-danger">{{ post.unread|unread_label }} new</span>
+          </li>
+          {% endfor %}
+        </ul>
+      {% endif %}
       <h2>Recent Posts</h2>
       {% if posts %}
         <ul class="list-group">
@@ -554,7 +1365,10 @@ TEMPLATE = """<!doctype html>
               {% else %}
                 <div class="avatar me-2">{{ (msg.nickname or msg.username)[:1] }}</div>
               {% endif %}
-              <div class="message bubble other">{{ msg.message }}</div>
+              <div class="message bubble other">
+                <a href="{{ url_for('chat_room', room_id=msg.room_id) }}"><small>#{{ msg.room_name }}</small></a>
+                {{ msg.message }}
+              </div>
             </div>
           {% endfor %}
         </div>
@@ -655,9 +1469,9 @@ TEMPLATE = """<!doctype html>
       <div class="fancy p-3 mb-3" style="white-space: pre-wrap;">{{ post.body }}</div>
 
       <h4>Comments</h4>
-      {% if comments %}
-        <ul class="list-group mb-3">
-          {% for c in comments %}
+      {# comments may be a lazy row iterator, so no truthiness test #}
+      {% for c in comments %}
+        {% if loop.first %}<ul class="list-group mb-3">{% endif %}
             <li class="list-group-item d-flex align-items-center">
               {% if c.avatar %}
                 <img src="{{ url_for('avatars', filename=c.avatar) }}" alt="avatar" class="avatar me-3" style="width:40px;height:40px;">
@@ -669,11 +1483,10 @@ TEMPLATE = """<!doctype html>
                 <p style="margin-bottom:0; white-space: pre-wrap;">{{ c.body }}</p>
               </div>
             </li>
-          {% endfor %}
-        </ul>
+        {% if loop.last %}</ul>{% endif %}
       {% else %}
         <p>No comments yet.</p>
-      {% endif %}
+      {% endfor %}
 
       {% if user %}
         <form method="POST" class="mb-3">
@@ -687,22 +1500,37 @@ TEMPLATE = """<!doctype html>
       {% endif %}
     {% endif %}
 
-    {# CHAT AUTH PAGE #}
-    {% if page == 'chat_auth' %}
-      <h2>Chat Room Access</h2>
-      <p>Only authorized full names can enter the chat room.</p>
+    {# CHAT ROOMS PAGE #}
+    {% if page == 'chat_rooms' %}
+      <h2>Chat Rooms</h2>
+      {% if rooms %}
+        <ul class="list-group mb-3">
+          {% for room in rooms %}
+            <li class="list-group-item">
+              <a href="{{ url_for('chat_room', room_id=room.id) }}"><strong>{{ room.name }}</strong></a>
+              {% if room.unread %}<span class="badge bg-danger">{{ room.unread|unread_label }} new</span>{% endif %}
+            </li>
+          {% endfor %}
+        </ul>
+      {% else %}
+        <p>You are not in any chat rooms yet. Create one, or ask a member to add you.</p>
+      {% endif %}
       <form method="POST" class="fancy p-3" novalidate>
         <div class="mb-3">
-          <label class="form-label">Full Name</label>
-          <input type="text" name="full_name" class="form-control" required maxlength="100" placeholder="Your full name">
+          <label class="form-label">New Room</label>
+          <input type="text" name="name" class="form-control" required maxlength="50" placeholder="Room name">
         </div>
-        <button type="submit" class="btn btn-danger">Request Access</button>
+        <button type="submit" class="btn btn-danger">Create Room</button>
       </form>
     {% endif %}
 
     {# CHAT PAGE #}
     {% if page == 'chat' %}
-      <h2>Chat Room</h2>
+      <h2>{{ room.name }}</h2>
+      <p class="text-muted">
+        Members:
+        {% for m in members %}{{ m.nickname or m.username }}{% if not loop.last %}, {% endif %}{% endfor %}
+      </p>
       <div class="chat-box mb-3" id="chatbox">
         {% for msg in messages %}
           <div class="d-flex mb-2 {% if msg.user_id == user.id %}justify-content-end{% else %}justify-content-start{% endif %}">
@@ -732,6 +1560,12 @@ TEMPLATE = """<!doctype html>
           <button type="submit" class="btn btn-danger">Send</button>
         </div>
       </form>
+      <form method="POST" action="{{ url_for('chat_room_members', room_id=room.id) }}" class="fancy p-3 mt-3" novalidate>
+        <div class="input-group">
+          <input type="text" name="username" class="form-control" placeholder="Username to add" maxlength="50" required>
+          <button type="submit" class="btn btn-danger">Add Member</button>
+        </div>
+      </form>
     {% endif %}
   </main>
 